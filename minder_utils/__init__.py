@@ -1,6 +1,7 @@
 import os
 
-logs_path = os.path.join(os.path.dirname(__file__), '..', 'logs')
+# the logs are saved next to the package, unless MINDER_UTILS_LOGS_PATH is set
+logs_path = os.environ.get('MINDER_UTILS_LOGS_PATH', os.path.join(os.path.dirname(__file__), '..', 'logs'))
 
 try: 
     os.mkdir(logs_path) 
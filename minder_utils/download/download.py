@@ -2,28 +2,37 @@ import requests
 import json
 import pandas as pd
 import io
-from pathlib import Path
+import csv
 import sys
 import os
 from minder_utils.util.util import progress_spinner, reformat_path, save_mkdir, please_dont_fail
 from minder_utils.configurations import token_path
+from minder_utils import logs_path
 import numpy as np
 from datetime import date, datetime
 import time
 import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 
 import http.client
 import logging
 from logging import FileHandler
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def setup_logging(loglevel):
 
     now = datetime.now()
     dt_string = now.strftime("%d-%m-%Y--%H-%M-%S")
 
     # the file handler receives all messages from level DEBUG on up, regardless
-    logging_path = os.path.join(os.path.dirname(__file__), '..', '..', 'logs', '{}_logging.txt'.format(dt_string))
+    logging_path = os.path.join(logs_path, '{}_logging.txt'.format(dt_string))
     fileHandler = FileHandler(logging_path)
     fileHandler.setLevel(logging.DEBUG)
     handlers = [fileHandler]
@@ -64,6 +73,125 @@ http.client.print = print_to_log
 setup_logging(logging.DEBUG)
 
 
+def _decode(response):
+    '''
+    Decodes the json body of a response. orjson is used when it is installed,
+    since the export listing can contain thousands of job records.
+    '''
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def _encode(obj):
+    '''
+    Encodes an object as a json body for a request, using orjson when it is installed.
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj)
+
+
+# the number of data chunks that are downloaded at the same time
+N_DOWNLOAD_WORKERS = 8
+
+# the size of the write buffer used for each downloaded csv
+CSV_WRITE_BUFFER = 1 << 20
+
+# the number of bytes read from the end of a saved csv when looking for its last rows
+CSV_TAIL_SIZE = 8192
+
+# the number of seconds for which the available datasets are cached
+INFO_CACHE_SECONDS = 300
+
+# the server is polled after 1 second, backing off by a factor of 1.5 up to every 30 seconds
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 30
+POLL_BACKOFF = 1.5
+# asks the server to hold a status request open until the job changes, if it supports it
+POLL_HEADERS = {'Prefer': 'wait={}'.format(MAX_POLL_INTERVAL)}
+
+
+def _next_poll_interval(interval):
+    return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, interval * POLL_BACKOFF))
+
+
+def _map_in_order(func, iterable, max_workers=N_DOWNLOAD_WORKERS):
+    '''
+    Applies ```func``` to the items of ```iterable``` on a pool of threads and yields
+    the results in the same order as the items. At most ```2 * max_workers``` results
+    are held in memory at any one time.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _csv_columns(data):
+    '''
+    Returns the column names from the header line of the bytes of a csv.
+    '''
+    end_of_header = data.find(b'\n')
+    header = data if end_of_header == -1 else data[:end_of_header]
+    return next(csv.reader([header.decode()]), [])
+
+
+def _write_csv_bytes(csv_file, data, header=True, saved_keys=None):
+    '''
+    Writes the bytes of a downloaded csv to a file opened in binary mode, without
+    parsing them. If ```header``` is ```False```, the first line of ```data``` is skipped.
+
+    If ```saved_keys``` is given, the rows at the start of ```data``` whose
+    ```(start_date, id)``` is in ```saved_keys``` are skipped too, since they are already
+    at the end of the file. Only these rows are parsed. Returns ```True``` once a
+    row that is not in ```saved_keys``` has been found.
+    '''
+    end_of_header = data.find(b'\n')
+    end_of_header = len(data) if end_of_header == -1 else end_of_header + 1
+    start = end_of_header
+    columns = _csv_columns(data) if saved_keys else []
+    if 'start_date' in columns and 'id' in columns:
+        date_position, id_position = columns.index('start_date'), columns.index('id')
+        while start < len(data):
+            end = data.find(b'\n', start)
+            end = len(data) if end == -1 else end + 1
+            row = next(csv.reader([data[start:end].decode()]), [])
+            if len(row) != len(columns) or (row[date_position], row[id_position]) not in saved_keys:
+                break
+            start = end
+
+    data = memoryview(data)
+    if header:
+        csv_file.write(data[:end_of_header])
+    csv_file.write(data[start:])
+    # makes sure that the next chunk starts on a new line
+    last_written = data[start:] if start < len(data) else data[:end_of_header if header else 0]
+    if len(last_written) > 0 and last_written[-1] != ord('\n'):
+        csv_file.write(b'\n')
+    return start < len(data) or not saved_keys
+
+
+def _read_csv_tail(file_name, columns, tail_size=CSV_TAIL_SIZE, **kwargs):
+    '''
+    Reads the rows in the last ```tail_size``` bytes of a csv, without loading the rest
+    of the file. The partial row at the start of the tail is dropped. Any keyword
+    arguments are passed to pd.read_csv(.).
+    '''
+    with open(file_name, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - tail_size))
+        tail = f.read()
+    # the first line is either the header or a partial row
+    tail = tail[tail.find(b'\n') + 1:] if b'\n' in tail else b''
+    if not tail.strip():
+        return pd.DataFrame(columns=columns)
+    return pd.read_csv(io.BytesIO(tail), names=columns, header=None, index_col=False, **kwargs)
+
 
 class Downloader:
     '''
@@ -89,11 +217,36 @@ class Downloader:
     def __init__(self):
         self.url = 'https://research.minder.care/api/'
         self.params = {'Authorization': self.token(), 'Content-Type': 'application/json'}
+        self._info_cache = None
+        self._info_cache_time = 0
+        # a single session is used for all of the requests so that connections are reused
+        self.session = requests.Session()
+        self.session.headers.update(self.params)
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        adapter = HTTPAdapter(pool_connections=4 * N_DOWNLOAD_WORKERS, pool_maxsize=4 * N_DOWNLOAD_WORKERS,
+                              max_retries=3)
+        self.session.mount('https://', adapter)
 
     def get_info(self):
         '''
         This function returns the available datasets on minder in the form of a
-        dictionary
+        dictionary. The response is cached for ```INFO_CACHE_SECONDS``` seconds, use
+        ```.refresh_info()``` to fetch it again before then.
+
+        Returns
+        ---------
+
+        - _: dict: 
+            This returns a dictionary of the available datasets.
+        '''
+        if self._info_cache is None or time.monotonic() - self._info_cache_time > INFO_CACHE_SECONDS:
+            return self.refresh_info()
+        return self._info_cache
+
+    def refresh_info(self):
+        '''
+        This function requests the available datasets on minder from the server,
+        ignoring the cached response.
 
         Returns
         ---------
@@ -104,17 +257,19 @@ class Downloader:
         print('Sending Request...')
         logging.debug('getting info')
 
-        reponse_func = please_dont_fail(requests.get, tries=3)
-        r = reponse_func(self.url + 'info/datasets', headers=self.params)
+        reponse_func = please_dont_fail(self.session.get, tries=3)
+        r = reponse_func(self.url + 'info/datasets')
         if r.status_code in [401, 403]:
             raise TypeError('Authentication failed!'\
                 ' Please check your token - it might be out of date. '\
                 'You might also not have authorization to complete your request.')
         try:
-            return r.json()
+            self._info_cache = _decode(r)
+            self._info_cache_time = time.monotonic()
         except json.decoder.JSONDecodeError:
             print('Get response ', r)
         logging.debug('info done')
+        return self._info_cache
 
     def _export_request(self, categories='all', since=None, until=None, organizations=None):
         '''
@@ -144,30 +299,36 @@ class Downloader:
         #         print('Job ID ', job['id'], 'is NOT deleted. Response code ', response.status_code)
         print('Creating new export request')
         logging.debug('making requests')
-        export_keys = {'datasets': {}}
+        export_keys = {}
         if since is not None:
             export_keys['since'] = self.convert_to_ISO(since)
         if until is not None:
             export_keys['until'] = self.convert_to_ISO(until)
         if organizations:
             export_keys['organizations'] = organizations
+        if categories == 'all':
+            category_set = None
+        elif isinstance(categories, str):
+            category_set = {categories}
+        else:
+            category_set = set(categories)
         info = self.get_info()['Categories']
-        for key in info:
-            for category in info[key]:
-                if category in categories or categories == 'all':
-                    export_keys['datasets'][category] = {}
+        export_keys['datasets'] = {category: {} for key in info for category in info[key]
+                                   if category_set is None or category in category_set}
         print('Exporting the ', export_keys['datasets'])
         print('From ', since, 'to', until)
-        logging.debug(f"request: {self.url + 'export'}; data={json.dumps(export_keys)}")
-        schedule_job = requests.post(self.url + 'export', data=json.dumps(export_keys), headers=self.params)
+        body = _encode(export_keys)
+        logging.debug(f"request: {self.url + 'export'}; data={body}")
+        schedule_job = self.session.post(self.url + 'export', data=body)
         job_id = schedule_job.headers['Content-Location']
-        reponse_func = please_dont_fail(requests.get, tries=3)
-        response = reponse_func(job_id, headers=self.params)
+        reponse_func = please_dont_fail(self.session.get, tries=3)
+        response = reponse_func(job_id)
         if response.status_code == 401:
             raise TypeError('Authentication failed!' \
                             ' Please check your token - it might be out of date.')
-        response = response.json()
+        response = _decode(response)
         waiting = True
+        poll_interval = MIN_POLL_INTERVAL
         while waiting:
             logging.debug('checking status')
             logging.debug(f'response: {response}')
@@ -175,9 +336,10 @@ class Downloader:
             if response['status'] == 202:
                 # the following waits for x seconds and runs an animation in the 
                 # mean time to make sure the user doesn't think the code is broken
-                progress_spinner(30, 'Waiting for the sever to complete the job', new_line_after=False)
-                reponse_func = please_dont_fail(requests.get, tries=3)
-                response = reponse_func(job_id, headers=self.params).json()
+                progress_spinner(poll_interval, 'Waiting for the sever to complete the job', new_line_after=False)
+                poll_interval = _next_poll_interval(poll_interval)
+                reponse_func = please_dont_fail(self.session.get, tries=3)
+                response = _decode(reponse_func(job_id, headers=POLL_HEADERS))
 
             elif response['status'] == 500:
                 sys.stdout.write('\r')
@@ -220,8 +382,8 @@ class Downloader:
         print('Creating new parallel export requests')
         logging.debug('creating new parallel export requests')
 
-        # the following creates a list of export keys to be called by the API
-        export_key_list = {}
+        # the following creates the encoded export keys to be sent to the API
+        export_body_dict = {}
         for category in categories_list:
             since = export_dict[category][0]
             until = export_dict[category][1]
@@ -233,14 +395,13 @@ class Downloader:
             if organizations:
                 export_keys['organizations'] = organizations
 
-            export_key_list[category] = export_keys
+            export_body_dict[category] = _encode(export_keys)
 
         # scheduling jobs for each of the requests:
         request_url_dict = {}
         schedule_job_dict = {}
         for category in categories_list:
-            export_keys = export_key_list[category]
-            schedule_job = requests.post(self.url + 'export', data=json.dumps(export_keys), headers=self.params)
+            schedule_job = self.session.post(self.url + 'export', data=export_body_dict[category])
             schedule_job_dict[category] = schedule_job
             request_url = schedule_job.headers['Content-Location']
             request_url_dict[category] = request_url
@@ -248,16 +409,20 @@ class Downloader:
         # checking whether the jobs have been completed:
         waiting = True
         waiting_for = {category: True for category in categories_list}
+        # each category backs off separately, so jobs that have just been scheduled are polled
+        # often while jobs that have been running for a while are polled less
+        poll_interval = {category: 0 for category in categories_list}
+        next_poll = {category: time.monotonic() for category in categories_list}
         job_id_dict = {}
         while waiting:
             logging.debug('checking status')
             for category in categories_list:
-                if not waiting_for[category]:
+                if not waiting_for[category] or next_poll[category] > time.monotonic():
                     continue
 
                 request_url = request_url_dict[category]
-                reponse_func = please_dont_fail(requests.get, tries=3)
-                response = reponse_func(request_url, headers=self.params)
+                reponse_func = please_dont_fail(self.session.get, tries=3)
+                response = reponse_func(request_url, headers=POLL_HEADERS)
                 if response.status_code in [401, 403]:
                     raise TypeError('Authentication failed!'\
                                 ' Please check your token - it might be out of date. '\
@@ -265,6 +430,8 @@ class Downloader:
                 
                 elif response.status_code == 202:
                     waiting_for[category] = True
+                    poll_interval[category] = _next_poll_interval(poll_interval[category])
+                    next_poll[category] = time.monotonic() + poll_interval[category]
 
                 elif response.status_code == 500:
                     sys.stdout.write('\r')
@@ -277,14 +444,16 @@ class Downloader:
                     waiting_for[category] = False
 
                 if not category in job_id_dict:
-                    response = response.json()
+                    response = _decode(response)
                     job_id_dict[category] = response['id']
 
 
             # if we are no longer waiting for a job to complete, move onto the downloads
             if True in list(waiting_for.values()):
                 logging.debug('waiting for server')
-                progress_spinner(30, 'Waiting for the sever to complete the job', new_line_after=False)
+                wait_time = min(next_poll[category] for category in categories_list if waiting_for[category])
+                progress_spinner(max(0, wait_time - time.monotonic()), 'Waiting for the sever to complete the job',
+                                 new_line_after=False)
             else:
                 sys.stdout.write('\n')
                 sys.stdout.write("The server has finished processing the requests")
@@ -354,16 +523,12 @@ class Downloader:
 
         '''
         save_path = reformat_path(save_path)
-        p = Path(save_path)
-        if not p.exists():
-            print('Target directory does not exist, creating a new folder')
-            logging.debug('target directory does not exist, creating a new folder')
-            save_mkdir(save_path)
+        save_mkdir(save_path)
         if export_index is None:
             if reload:
                 self._export_request(categories=categories, since=since, until=until, organizations=organizations)
-        reponse_func = please_dont_fail(requests.get, tries=3)
-        data = reponse_func(self.url + 'export', headers=self.params).json()
+        reponse_func = please_dont_fail(self.session.get, tries=3)
+        data = _decode(reponse_func(self.url + 'export'))
         export_index = -1 if export_index is None else export_index
         if export_index is None:
             if not reload:
@@ -385,35 +550,46 @@ class Downloader:
         logging.debug('start to export job')
         logging.debug('downloading the data')
         categories_downloaded = []
-        for idx, record in enumerate(data[export_index]['jobRecord']['output']):
-            print('Exporting {}/{}'.format(idx + 1, len(data[export_index]['jobRecord']['output'])).ljust(20, ' '),
-                  str(record['type']).ljust(20, ' '), end=' ')
-            reponse_func = please_dont_fail(requests.get, tries=3)
-            content = reponse_func(record['url'], headers=self.params)
-            if content.status_code != 200:
-                print('Fail, Response code {}'.format(content.status_code))
-            else:
-                if record['type'] in categories_downloaded:
-                    mode = 'a'
-                    header = False
+        output = data[export_index]['jobRecord']['output']
+        # the chunks only need to be parsed if they are changed before saving, otherwise
+        # the bytes from the server are written straight to the files
+        raw = not remove_id and not save_index
+        chunks = _map_in_order(lambda record: self._download_chunk(record['url'], raw=raw, index_col=False),
+                               output)
+        # each csv is opened once with a large buffer and kept open for all of its chunks
+        with contextlib.ExitStack() as open_files:
+            csv_files = {}
+            for idx, (record, (status_code, csv_content)) in enumerate(zip(output, chunks)):
+                print('Exporting {}/{}'.format(idx + 1, len(output)).ljust(20, ' '),
+                      str(record['type']).ljust(20, ' '), end=' ')
+                if status_code != 200:
+                    print('Fail, Response code {}'.format(status_code))
                 else:
-                    mode = 'a' if append else 'w'
-                    header = not Path(os.path.join(save_path, record['type'] + '.csv')).exists() or mode == 'w'
+                    if record['type'] in csv_files:
+                        header = False
+                    else:
+                        file_name = os.path.join(save_path, record['type'] + '.csv')
+                        mode = 'a' if append else 'w'
+                        header = mode == 'w' or not os.path.exists(file_name)
+                        if raw:
+                            csv_file = open(file_name, mode + 'b', buffering=CSV_WRITE_BUFFER)
+                        else:
+                            csv_file = open(file_name, mode, newline='', buffering=CSV_WRITE_BUFFER)
+                        csv_files[record['type']] = open_files.enter_context(csv_file)
 
-                csv_content = pd.read_csv(io.StringIO(content.text), index_col=False)
-                
-                if remove_id:
-                    if record['type'] not in ['homes', 'device_types', 'patients']:
-                        try:
-                            csv_content = csv_content.drop(['id'], axis=1)
-                        except KeyError:
-                            pass
-                
-                csv_content.to_csv(os.path.join(save_path, record['type'] + '.csv'),
-                                   mode=mode,
-                                   header=header, index=save_index)
-                categories_downloaded.append(record['type'])
-                print('Success')
+                    if raw:
+                        _write_csv_bytes(csv_files[record['type']], csv_content, header=header)
+                    else:
+                        if remove_id:
+                            if record['type'] not in ['homes', 'device_types', 'patients']:
+                                try:
+                                    csv_content = csv_content.drop(['id'], axis=1)
+                                except KeyError:
+                                    pass
+
+                        csv_content.to_csv(csv_files[record['type']], header=header, index=save_index)
+                    categories_downloaded.append(record['type'])
+                    print('Success')
         logging.debug('done with export')
 
         if return_categories_downloaded:
@@ -423,6 +599,52 @@ class Downloader:
 
 
 
+    def _download_chunk(self, url, raw=False, **kwargs):
+        '''
+        This is an internal function that downloads a single csv chunk of an export job.
+        It is safe to call from several threads at once.
+
+        Arguments
+        ---------
+
+        - url: string:
+            This is the url of the chunk, as given in the output of the export job.
+
+        - raw: bool:
+            If ```True```, the chunk is returned as the bytes sent by the server
+            rather than being parsed.
+            Default: ```False```
+
+        - kwargs:
+            These are passed to pd.read_csv(.) when parsing the chunk.
+
+        Returns
+        ---------
+
+        - _: tuple:
+            The response code and the chunk as a dataframe, or as bytes if ```raw```
+            is ```True```. The chunk is ```None``` if the download failed.
+
+        '''
+        def download():
+            content = self.session.get(url, stream=True)
+            if content.status_code != 200:
+                content.close()
+                return content.status_code, None
+            if raw:
+                return content.status_code, content.content
+            # read the csv straight from the socket rather than decoding the whole body first
+            content.raw.decode_content = True
+            with content:
+                return content.status_code, pd.read_csv(content.raw, **kwargs)
+
+        # the body is read inside the retried function, so a dropped connection
+        # part way through a chunk downloads the whole chunk again
+        reponse_func = please_dont_fail(download, tries=3)
+        return reponse_func()
+
+
+
     def refresh_at_once(self, since, categories=None, until=None,
                         save_path='./data/raw_data/', 
                         export_index=None):
@@ -472,7 +694,7 @@ class Downloader:
                 categories = [categories]
 
         print('Checking the index saving method.')
-        cols = pd.read_csv(save_path+categories[0]+'.csv', index_col=False, header=0, nrows=0).columns.tolist()
+        cols = pd.read_csv(os.path.join(save_path, categories[0] + '.csv'), index_col=False, header=0, nrows=0).columns.tolist()
         if np.any(['Unnamed:' in col for col in cols]):
             index_col=0
             save_index=True
@@ -490,13 +712,15 @@ class Downloader:
         print('Removing possible duplicates...')
         logging.debug('removing possible duplicates...')
 
-        for cat in categories_downloaded:
+        # categories_downloaded has an entry per chunk, so each file is only de-duplicated once
+        for cat in dict.fromkeys(categories_downloaded):
+            file_name = os.path.join(save_path, cat + '.csv')
             logging.debug('loading {}'.format(cat))
-            data = pd.read_csv(save_path + cat + '.csv', index_col=index_col)
+            data = pd.read_csv(file_name, index_col=index_col)
             logging.debug('de-duplicating {}'.format(cat))
             data = data.drop_duplicates().reset_index(drop=True)
             logging.debug('saving {}'.format(cat))
-            data.to_csv(save_path + cat + '.csv', index=save_index)
+            data.to_csv(file_name, index=save_index)
         print('Done')
 
         return
@@ -545,21 +769,37 @@ class Downloader:
         mode_dict = {}
         print('Checking current files...')
         logging.debug('checking dates from current files')
-        last_rows = {}
+        saved_columns = {}
+        saved_keys = {}
         for category in categories:
-            file_path = os.path.join(save_path, category)
-            p = Path(file_path + '.csv')
-            if not p.exists():
+            file_name = os.path.join(save_path, category + '.csv')
+            if not os.path.exists(file_name):
                 since = None
             else:
-                data = pd.read_csv(file_path + '.csv')
-                if 'start_date' in data.columns:
-                    # add the following to avoid a duplicate of the last and first row
-                    last_rows[category] = data[['start_date']].iloc[-1, :].to_numpy()
-                    since = pd.to_datetime(data['start_date'].loc[data['start_date'].last_valid_index()])
+                # only the header and the last rows are read, since the files can be very large
+                columns = pd.read_csv(file_name, nrows=0).columns.tolist()
+                saved_columns[category] = columns
+                if 'start_date' in columns:
+                    # the tail is grown until it reaches back past every row at the last date,
+                    # so that all of those rows are in saved_keys
+                    file_size = os.path.getsize(file_name)
+                    tail_size = CSV_TAIL_SIZE
+                    while True:
+                        data = _read_csv_tail(file_name, columns, tail_size=tail_size, dtype=str)
+                        dates = data['start_date'].dropna()
+                        if tail_size >= file_size or (len(dates) > 0 and dates.iloc[0] != dates.iloc[-1]):
+                            break
+                        tail_size *= 8
+                    last_date = data['start_date'].loc[data['start_date'].last_valid_index()]
+                    if 'id' in data.columns:
+                        # the rows at the last date will be downloaded again, so they are
+                        # kept to avoid duplicating them
+                        last_rows = data[data['start_date'] == last_date]
+                        saved_keys[category] = set(zip(last_rows['start_date'], last_rows['id']))
+                    since = pd.to_datetime(last_date)
                     if self.convert_to_ISO(since) > self.convert_to_ISO(until):
-                        # change since to earliest date and overwrite all data for this category
-                        since = pd.to_datetime(data[['start_date']].iloc[0, 0])
+                        # change since to earliest date and merge all data for this category
+                        since = pd.to_datetime(pd.read_csv(file_name, usecols=['start_date'], nrows=1).iloc[0, 0])
                         # if the earliest date is after until, then we error
                         if self.convert_to_ISO(since) > self.convert_to_ISO(until):
                             raise TypeError('Please check your inputs. For {} we found that you tried refreshing' \
@@ -579,63 +819,94 @@ class Downloader:
 
         logging.debug('downloading the data')
 
-        reponse_func = please_dont_fail(requests.get, tries=3)
-        data = reponse_func(self.url + 'export', headers=self.params).json()
+        reponse_func = please_dont_fail(self.session.get, tries=3)
+        data = _decode(reponse_func(self.url + 'export'))
+        # indexing the jobs once avoids requesting each job again or scanning the job history
+        job_by_id = {job['id']: job for job in data}
         for category in categories:
 
             if not category in request_url_dict:
                 raise TypeError('Uh-oh! Something seems to have gone wrong.' \
                                 'Please check the inputs to the function and try again.' \
                                 ' Looks as if category {} caused the problem'.format(category))
-            reponse_func = please_dont_fail(requests.get, tries=3)
-            content = reponse_func(request_url_dict[category], headers=self.params)
-            output = json.load(io.StringIO(content.text))['jobRecord']['output']
-
-            for n_output, data_chunk in enumerate(output):
-                reponse_func = please_dont_fail(requests.get, tries=3)
-                content = reponse_func(data_chunk['url'], headers=self.params)
-                sys.stdout.write('\r')
-                sys.stdout.write("For {}, exporting {}/{}".format(category, n_output + 1, len(output)))
-                sys.stdout.flush()
-                if content.status_code != 200:
-                    sys.stdout.write('\n')
-                    sys.stdout.write('\r')
-                    sys.stdout.write('Fail, Response code {} for category {}'.format(content.status_code, category))
-                    sys.stdout.write('\n')
-                    sys.stdout.flush()
-                else:
-                    current_data = pd.read_csv(io.StringIO(content.text))
-
-                    if Path(save_path + category + '.csv').exists():
-                        data_to_save = pd.read_csv(save_path + category + '.csv', index_col=0)
-                        data_to_save = pd.concat([data_to_save, current_data], ignore_index=True)
-                        #data_to_save = data_to_save.append(current_data, ignore_index=True)
-                        data_to_save = data_to_save.drop_duplicates(ignore_index=True).reset_index(drop=True)
-
-                    else:
-                        data_to_save = current_data
-
-                    '''
-                    header = (not Path(save_path + category + '.csv').exists()) or mode_dict[category] == 'w'
-                    # checking whether the first line is a duplicate of the end of the previous file
-                    if np.all(current_data[['start_date', 'id']].iloc[0, :] == last_rows[category]):
-                        current_data.iloc[1:, :].reset_index(drop=True).to_csv(save_path + category + '.csv',
-                                                                               mode=mode_dict[category],
-                                                                               header=header)
-                    else:
-                        current_data.to_csv(save_path + category + '.csv', mode=mode_dict[category],
-                                            header=header)
-                    '''
-
-                    data_to_save.to_csv(save_path + category + '.csv', mode='w',
-                                        header=True)
-
+            job = job_by_id.get(job_id_dict.get(category))
+            if job is None:
+                reponse_func = please_dont_fail(self.session.get, tries=3)
+                job = _decode(reponse_func(request_url_dict[category]))
+            output = job['jobRecord']['output']
+
+            file_name = os.path.join(save_path, category + '.csv')
+            columns = saved_columns.get(category)
+            index = columns is None or any('Unnamed:' in col for col in columns)
+            if mode_dict.get(category) == 'a' and not index:
+                self._refresh_append(category, file_name, output, columns=columns,
+                                     saved_keys=saved_keys.get(category))
+            else:
+                # new files and files saved with an index keep their index, and files that are
+                # downloaded again from their earliest date are merged with the saved data
+                self._refresh_merge(category, file_name, output, index=index)
             sys.stdout.write('\n')
 
         print('Success')
 
         return
 
+    def _refresh_append(self, category, file_name, output, columns, saved_keys):
+        '''
+        This is an internal function that downloads the chunks of a refresh job and appends
+        them to a file saved without an index, streaming the bytes from the server straight
+        to the file. The rows at the start of the download that are already at the end of
+        the file are skipped.
+        '''
+        chunks = _map_in_order(lambda data_chunk: self._download_chunk(data_chunk['url'], raw=True), output)
+        with open(file_name, 'ab', buffering=CSV_WRITE_BUFFER) as csv_file:
+            for n_output, (status_code, content) in enumerate(chunks):
+                self._print_refresh_progress(category, n_output, len(output), status_code)
+                if status_code != 200:
+                    continue
+                if _csv_columns(content) != columns:
+                    # the columns do not match the saved file, so the chunk is aligned with pandas
+                    current_data = pd.read_csv(io.BytesIO(content), index_col=False, dtype=str)
+                    if saved_keys and 'id' in current_data.columns:
+                        current_data = current_data[[key not in saved_keys for key in
+                                                     zip(current_data['start_date'], current_data['id'])]]
+                    current_data.reindex(columns=columns).to_csv(csv_file, header=False, index=False)
+                elif _write_csv_bytes(csv_file, content, header=False, saved_keys=saved_keys):
+                    saved_keys = None
+
+    def _refresh_merge(self, category, file_name, output, index=True):
+        '''
+        This is an internal function that downloads the chunks of a refresh job and merges
+        them with the saved file, if there is one, removing duplicates. The saved file is
+        only rewritten once all of the chunks have been downloaded, and is left as it is
+        if none of them could be downloaded.
+        '''
+        chunks = _map_in_order(lambda data_chunk: self._download_chunk(data_chunk['url']), output)
+        downloaded = []
+        for n_output, (status_code, current_data) in enumerate(chunks):
+            self._print_refresh_progress(category, n_output, len(output), status_code)
+            if status_code == 200:
+                downloaded.append(current_data)
+        if not downloaded:
+            return
+        if os.path.exists(file_name):
+            downloaded.insert(0, pd.read_csv(file_name, index_col=0 if index else False))
+        data_to_save = pd.concat(downloaded, ignore_index=True)
+        data_to_save = data_to_save.drop_duplicates(ignore_index=True).reset_index(drop=True)
+        data_to_save.to_csv(file_name, mode='w', header=True, index=index)
+
+    @staticmethod
+    def _print_refresh_progress(category, n_output, n_outputs, status_code):
+        sys.stdout.write('\r')
+        sys.stdout.write("For {}, exporting {}/{}".format(category, n_output + 1, n_outputs))
+        sys.stdout.flush()
+        if status_code != 200:
+            sys.stdout.write('\n')
+            sys.stdout.write('\r')
+            sys.stdout.write('Fail, Response code {} for category {}'.format(status_code, category))
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
     def get_category_names(self, measurement_name='all'):
         '''
         This function allows you to get the category names from a given measurement name.
@@ -721,7 +992,13 @@ class Downloader:
             This is the date converted to ISO.
 
         '''
-        date = pd.to_datetime(date, dayfirst=True)
+        # pd.to_datetime(.) is slow, so it is only used when the date is not
+        # already a datetime or an ISO formatted string
+        if not isinstance(date, datetime):
+            try:
+                date = datetime.fromisoformat(date)
+            except (TypeError, ValueError):
+                date = pd.to_datetime(date, dayfirst=True)
         return date.strftime('%Y-%m-%dT%H:%M:%S.000Z')
 
 
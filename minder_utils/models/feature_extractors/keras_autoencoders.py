@@ -3,32 +3,51 @@ from tensorflow.keras.layers import Dense, Input, Conv2D, Flatten
 from tensorflow.keras.callbacks import EarlyStopping
 import os
 from tensorflow import keras
+import tensorflow as tf
 import numpy as np
 
 
+def _bfloat16_supported():
+    # bfloat16 matmuls are only faster than float32 on GPUs with compute capability 8.0 or above
+    for gpu in tf.config.list_physical_devices('GPU'):
+        if tf.config.experimental.get_device_details(gpu).get('compute_capability', (0, 0)) >= (8, 0):
+            return True
+    return False
+
+
+# the hidden layers compute in bfloat16 where the hardware supports it. The latent and
+# output layers are always float32, to keep the loss stable and the features in float32.
+HIDDEN_DTYPE = 'mixed_bfloat16' if _bfloat16_supported() else 'float32'
+
+
+def _build_nn(input_dim, encoding_dim):
+    input_layer = Input(shape=(input_dim,))
+    encoded = Dense(15, activation='relu', dtype=HIDDEN_DTYPE)(input_layer)
+    encoded = Dense(10, activation='relu', dtype=HIDDEN_DTYPE)(encoded)
+    encoded = Dense(encoding_dim, activation='relu', name='latent', dtype='float32')(encoded)
+    decoded = Dense(10, activation='relu', dtype=HIDDEN_DTYPE)(encoded)
+    decoded = Dense(15, activation='relu', dtype=HIDDEN_DTYPE)(decoded)
+    decoded = Dense(input_dim, activation='sigmoid', dtype='float32')(decoded)
+    return Model(input_layer, encoded), Model(input_layer, decoded)
+
+
+def _build_cnn(input_dim, encoding_dim):
+    input_layer = Input(shape=input_dim)
+    encoded = Conv2D(4, (3, 3), activation='relu', padding='same', dtype=HIDDEN_DTYPE)(input_layer)
+    encoded = Conv2D(3, (3, 3), activation='relu', padding='same', dtype=HIDDEN_DTYPE)(encoded)
+    latent = Flatten(name='latent', dtype='float32')(encoded)
+    decoded = Conv2D(4, (3, 3), activation='relu', padding='same', dtype=HIDDEN_DTYPE)(encoded)
+    decoded = Conv2D(3, (3, 3), activation='sigmoid', padding='same', dtype='float32')(decoded)
+    return Model(input_layer, latent), Model(input_layer, decoded)
+
+
+_BUILDERS = {'nn': _build_nn, 'cnn': _build_cnn}
+
+
 def get_ae_model(model_type='nn', input_dim=(8, 14, 3), encoding_dim=24 * 7):
-    if model_type == 'nn':
-        
-        input_layer = Input(shape=(input_dim,))
-        encoded = Dense(15, activation='relu')(input_layer)
-        encoded = Dense(10, activation='relu')(encoded)
-        encoded = Dense(encoding_dim, activation='relu', name='latent')(encoded)
-        decoded = Dense(10, activation='relu')(encoded)
-        decoded = Dense(15, activation='relu')(decoded)
-        decoded = Dense(input_dim, activation='sigmoid')(decoded)
-        encoder = Model(input_layer, encoded)
-        autoencoder = Model(input_layer, decoded)
-    elif model_type == 'cnn':
-        input_layer = Input(shape=input_dim)
-        encoded = Conv2D(4, (3, 3), activation='relu', padding='same')(input_layer)
-        encoded = Conv2D(3, (3, 3), activation='relu', padding='same')(encoded)
-        latent = Flatten(name='latent')(encoded)
-        decoded = Conv2D(4, (3, 3), activation='relu', padding='same')(encoded)
-        decoded = Conv2D(3, (3, 3), activation='sigmoid', padding='same')(decoded)
-        encoder = Model(input_layer, latent)
-        autoencoder = Model(input_layer, decoded)
-    else:
+    if model_type not in _BUILDERS:
         raise NotImplementedError()
+    encoder, autoencoder = _BUILDERS[model_type](input_dim, encoding_dim)
     autoencoder.compile(optimizer='adam', loss='mse')
     return encoder, autoencoder
 
@@ -39,34 +58,57 @@ class Extractor:
         self.epochs = 100
         self.batch_size = 512
         self.existing_models = {}
+        self._infer = {}
         self.save_path = save_path
 
-    def train(self, data, model_type, normalisation=None, input_dim=(8, 14, 3), encoding_dim=24 * 7):
+    def train(self, data, model_type, normalisation=None, input_dim=(8, 14, 3), encoding_dim=24 * 7,
+              data_format='NCHW'):
         if self.save_path is not None:
             try:
                 encoder = keras.models.load_model(os.path.join(self.save_path, model_type + str(normalisation)+ '.h5'))
                 self.existing_models[model_type + str(normalisation)] = encoder
+                self._infer.pop(model_type + str(normalisation), None)
             except (OSError, FileNotFoundError):
                 pass
         if model_type + str(normalisation) in self.existing_models:
             return
         print('Train Extractor: ', model_type, normalisation)
         encoder, model = get_ae_model(model_type, input_dim, encoding_dim)
-        # data = data.reshape(data.shape[0], -1)
         # data = normalise(data, normalisation)
-        if model_type == 'nn':
-            data = data.reshape(data.shape[0], -1)
-        else:
-            # data = data.reshape([data.shape[0], 8, 14, 3])
-            data = data.transpose(0, 2, 3, 1)
+        data = self._to_model_layout(data, model_type, data_format)
         model.fit(data, data, epochs=self.epochs, batch_size=self.batch_size, callbacks=self.callbacks, verbose=0)
         self.existing_models[model_type + str(normalisation)] = encoder
+        self._infer.pop(model_type + str(normalisation), None)
         encoder.save(os.path.join(self.save_path, model_type + str(normalisation)) + '.h5')
 
-    def transform(self, data, model_type, normalisation=None):
+    def transform(self, data, model_type, normalisation=None, data_format='NCHW'):
+        data = self._to_model_layout(data, model_type, data_format)
+        infer = self._get_infer(model_type + str(normalisation))
+        data = tf.convert_to_tensor(data, dtype=tf.float32)
+        return np.concatenate([infer(data[i:i + self.batch_size]).numpy()
+                               for i in range(0, max(len(data), 1), self.batch_size)])
+
+    @staticmethod
+    def _to_model_layout(data, model_type, data_format):
+        # the cnn expects channels last. Data that is already NHWC is passed through
+        # as is, which saves a full copy of the array on every call.
         if model_type == 'nn':
-            data = data.reshape(data.shape[0], -1)
-        else:
-            # data = data.reshape([data.shape[0], 8, 14, 3])
-            data = data.transpose(0, 2, 3, 1)
-        return self.existing_models[model_type + str(normalisation)].predict(data)
+            return data.reshape(data.shape[0], -1)
+        if data_format == 'NHWC':
+            return data
+        if data_format == 'NCHW':
+            return np.ascontiguousarray(data.transpose(0, 2, 3, 1))
+        raise ValueError('data_format must be either NCHW or NHWC, got {}'.format(data_format))
+
+    def _get_infer(self, key):
+        # calling the traced model directly avoids the per call overhead of model.predict
+        if key not in self._infer:
+            model = self.existing_models[key]
+
+            def infer(x):
+                return model(x, training=False)
+
+            # the model call has no python control flow, so autograph has nothing to convert
+            self._infer[key] = tf.function(infer, input_signature=[tf.TensorSpec(model.input_shape, tf.float32)],
+                                           autograph=False)
+        return self._infer[key]
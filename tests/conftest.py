@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# importing minder_utils.download writes a log file, which is kept out of the repository
+os.environ.setdefault('MINDER_UTILS_LOGS_PATH', tempfile.mkdtemp(prefix='minder_utils_logs_'))
@@ -0,0 +1,145 @@
+import io
+
+import pandas as pd
+import pytest
+
+from minder_utils.download.download import Downloader, _csv_columns, _read_csv_tail, _write_csv_bytes
+
+
+def write(data, **kwargs):
+    csv_file = io.BytesIO()
+    found_new_row = _write_csv_bytes(csv_file, data, **kwargs)
+    return csv_file.getvalue(), found_new_row
+
+
+def test_csv_columns():
+    assert _csv_columns(b'start_date,id,value\n2021-10-05,a,1\n') == ['start_date', 'id', 'value']
+    assert _csv_columns(b'start_date,id') == ['start_date', 'id']
+    assert _csv_columns(b'start_date,id\r\n') == ['start_date', 'id']
+
+
+def test_write_header_only_chunk():
+    assert write(b'start_date,id\n', header=True) == (b'start_date,id\n', True)
+    assert write(b'start_date,id\n', header=False) == (b'', True)
+    # the header is still ended with a new line when the server does not send one
+    assert write(b'start_date,id', header=True) == (b'start_date,id\n', True)
+    assert write(b'start_date,id', header=False) == (b'', True)
+
+
+def test_write_chunk_without_trailing_new_line():
+    csv_file = io.BytesIO()
+    _write_csv_bytes(csv_file, b'start_date,id\n2021-10-05,a', header=True)
+    _write_csv_bytes(csv_file, b'start_date,id\n2021-10-06,b', header=False)
+    assert csv_file.getvalue() == b'start_date,id\n2021-10-05,a\n2021-10-06,b\n'
+
+
+def test_write_crlf_chunk_skips_saved_rows():
+    data = b'start_date,id,value\r\n2021-10-05,a,1\r\n2021-10-05,b,2\r\n2021-10-06,c,3\r\n'
+    saved_keys = {('2021-10-05', 'a'), ('2021-10-05', 'b')}
+    assert write(data, header=False, saved_keys=saved_keys) == (b'2021-10-06,c,3\r\n', True)
+
+
+def test_write_chunk_of_only_saved_rows():
+    data = b'start_date,id,value\n2021-10-05,a,1\n2021-10-05,b,2\n'
+    saved_keys = {('2021-10-05', 'a'), ('2021-10-05', 'b')}
+    assert write(data, header=False, saved_keys=saved_keys) == (b'', False)
+    # rows after the first new row are kept, even if they match a saved row
+    data = b'start_date,id,value\n2021-10-06,c,3\n2021-10-05,a,1\n'
+    assert write(data, header=False, saved_keys=saved_keys) == (b'2021-10-06,c,3\n2021-10-05,a,1\n', True)
+
+
+def test_read_csv_tail_drops_partial_first_line(tmp_path):
+    file_name = tmp_path / 'data.csv'
+    rows = ['2021-10-{:02d},id{},{}'.format(i % 28 + 1, i, i) for i in range(100)]
+    file_name.write_text('start_date,id,value\n' + '\n'.join(rows) + '\n')
+    columns = ['start_date', 'id', 'value']
+
+    tail = _read_csv_tail(str(file_name), columns, tail_size=len(rows[-1]) * 3 + 2, dtype=str)
+    assert tail.columns.tolist() == columns
+    assert tail.values.tolist() == [row.split(',') for row in rows[-2:]]
+
+    # when the whole file fits in the tail, only the header is dropped
+    tail = _read_csv_tail(str(file_name), columns, tail_size=10 ** 6, dtype=str)
+    assert len(tail) == len(rows)
+
+    header_only = tmp_path / 'header_only.csv'
+    header_only.write_text('start_date,id,value\n')
+    assert _read_csv_tail(str(header_only), columns).empty
+
+
+@pytest.fixture
+def downloader():
+    return object.__new__(Downloader)
+
+
+def test_refresh_merge_keeps_file_when_every_chunk_fails(tmp_path, downloader):
+    file_name = tmp_path / 'raw_door_sensor.csv'
+    file_name.write_bytes(b',start_date,id\n0,2021-10-05,a\n')
+    downloader._download_chunk = lambda url: (500, None)
+
+    downloader._refresh_merge('raw_door_sensor', str(file_name), [{'url': 'a'}, {'url': 'b'}])
+
+    assert file_name.read_bytes() == b',start_date,id\n0,2021-10-05,a\n'
+
+
+def test_refresh_merge_keeps_file_when_download_raises(tmp_path, downloader):
+    file_name = tmp_path / 'raw_door_sensor.csv'
+    file_name.write_bytes(b',start_date,id\n0,2021-10-05,a\n')
+
+    def download_chunk(url):
+        if url == 'b':
+            raise RuntimeError('We tried 3 times and it did not work')
+        return 200, pd.DataFrame({'start_date': ['2021-10-06'], 'id': ['b']})
+
+    downloader._download_chunk = download_chunk
+    with pytest.raises(RuntimeError):
+        downloader._refresh_merge('raw_door_sensor', str(file_name), [{'url': 'a'}, {'url': 'b'}])
+
+    assert file_name.read_bytes() == b',start_date,id\n0,2021-10-05,a\n'
+
+
+def test_refresh_merge_keeps_saved_rows_and_index(tmp_path, downloader):
+    file_name = tmp_path / 'raw_door_sensor.csv'
+    file_name.write_bytes(b',start_date,id\n0,2021-10-05,a\n1,2021-10-07,c\n')
+    chunks = {'a': (200, pd.DataFrame({'start_date': ['2021-10-05', '2021-10-06'], 'id': ['a', 'b']})),
+              'b': (500, None)}
+    downloader._download_chunk = lambda url: chunks[url]
+
+    downloader._refresh_merge('raw_door_sensor', str(file_name), [{'url': url} for url in chunks])
+
+    assert file_name.read_bytes() == b',start_date,id\n0,2021-10-05,a\n1,2021-10-07,c\n2,2021-10-06,b\n'
+
+
+def test_refresh_merge_new_file_is_saved_with_an_index(tmp_path, downloader):
+    file_name = tmp_path / 'raw_door_sensor.csv'
+    chunks = {'a': (200, pd.DataFrame({'start_date': ['2021-10-05'], 'id': ['a']})),
+              'b': (200, pd.DataFrame({'start_date': ['2021-10-05', '2021-10-06'], 'id': ['a', 'b']}))}
+    downloader._download_chunk = lambda url: chunks[url]
+
+    downloader._refresh_merge('raw_door_sensor', str(file_name), [{'url': url} for url in chunks])
+
+    assert file_name.read_bytes() == b',start_date,id\n0,2021-10-05,a\n1,2021-10-06,b\n'
+
+
+def test_refresh_merge_without_index(tmp_path, downloader):
+    file_name = tmp_path / 'raw_door_sensor.csv'
+    file_name.write_bytes(b'start_date,id\n2021-10-05,a\n')
+    downloader._download_chunk = lambda url: (200, pd.DataFrame({'start_date': ['2021-10-06'], 'id': ['b']}))
+
+    downloader._refresh_merge('raw_door_sensor', str(file_name), [{'url': 'a'}], index=False)
+
+    assert file_name.read_bytes() == b'start_date,id\n2021-10-05,a\n2021-10-06,b\n'
+
+
+def test_refresh_append_skips_saved_rows(tmp_path, downloader):
+    file_name = tmp_path / 'raw_door_sensor.csv'
+    file_name.write_bytes(b'start_date,id\n2021-10-05,a\n2021-10-05,b\n')
+    chunks = {'a': (200, b'start_date,id\n2021-10-05,a\n'), 'b': (500, None),
+              'c': (200, b'start_date,id\n2021-10-05,b\n2021-10-06,c\n')}
+    downloader._download_chunk = lambda url, raw=False: chunks[url]
+
+    downloader._refresh_append('raw_door_sensor', str(file_name), [{'url': url} for url in chunks],
+                               columns=['start_date', 'id'],
+                               saved_keys={('2021-10-05', 'a'), ('2021-10-05', 'b')})
+
+    assert file_name.read_bytes() == b'start_date,id\n2021-10-05,a\n2021-10-05,b\n2021-10-06,c\n'